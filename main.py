@@ -1,23 +1,113 @@
 import typing as tp
+import bisect
 import csv
-import PyPDF2
+import functools
+import orjson
+import pypdfium2 as pdfium
 import re
 import requests
+import time
 import os
 import uuid
 import click
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from datetime import datetime
 from dotenv import load_dotenv
 from typing import List, Dict, Any, Optional
 
-def pdf_to_text(file_path: str) -> str:
-    with open(file_path, "rb") as file:
-        reader = PyPDF2.PdfReader(file)
-        text = ""
-        for page in reader.pages:
-            text += page.extract_text()
-        return text
+# Прекомпилированные паттерны: parse_bank_statement и convert_to_zenmoney_format
+# вызываются на каждую выписку/транзакцию, компиляция не должна повторяться
+# Служебные строки выписки, вырезаются одним проходом.
+# [^\n₽]{0,N} вместо .*? — на обрезанных PDF без ₽ ленивый .*? давал
+# квадратичный перебор, ограниченный класс фейлится линейно
+_RE_NOISE = re.compile(
+    r'Страница \d+ из \d+'
+    r'|Продолжение на следующей странице'
+    r'|Входящий остаток[^\n₽]{0,200}₽'
+    r'|Исходящий остаток[^\n₽]{0,200}₽'
+)
+_RE_DATETIME = re.compile(r'(\d{2}\.\d{2}\.\d{4})\s+в\s+(\d{2}:\d{2})')
+_RE_DATE = re.compile(r'(\d{2}\.\d{2}\.\d{4})')
+_RE_CARD = re.compile(r'\*(\d{4,5})')
+_RE_AMOUNT = re.compile(r'([+\-–])\s*(\d{1,3}(?:\s+\d{3})*(?:,\d{2})?)\s*₽')
+_RE_TAIL = re.compile(r'[+\-–]\s*\d[^\n]{0,80}₽\s*$', flags=re.MULTILINE)
+_RE_WS = re.compile(r'\s+')
+_RE_SKIP = re.compile('Описание операции|Дата и время|МСК|Страница')
+_RE_LOOSE_DATE = re.compile(r'(\d{1,2})[./](\d{1,2})[./](\d{4})')
+_RE_ISO_DATE = re.compile(r'\d{4}-\d{2}-\d{2}')
+# Все поддерживаемые форматы дат — перестановки DD/MM/YYYY; один матч
+# вместо каскада strptime, который кидает ValueError на каждый промах
+_RE_ANYDATE = re.compile(
+    r'(?:(?P<y1>\d{4})[-.](?P<m1>\d{1,2})[-.](?P<d1>\d{1,2}))'
+    r'|(?:(?P<d2>\d{1,2})[./](?P<m2>\d{1,2})[./](?P<y2>\d{4}))'
+)
+# Чистка сумм одним C-проходом: убрать пробелы-разделители тысяч,
+# запятую в точку, длинное тире в минус
+_AMOUNT_TT = str.maketrans({' ': '', ',': '.', '–': '-'})
+
+def _clean_amount(sign: str, value: str) -> str:
+    return ('-' if sign == '–' else sign) + value.translate(_AMOUNT_TT)
+
+_PAYEE_PATTERNS = (
+    re.compile(r'Входящий перевод СБП, ([^,]+)'),
+    re.compile(r'Исходящий перевод СБП, ([^,]+)'),
+    re.compile(r'Оплата товаров и услуг ([A-Z_0-9]+)'),
+)
+
+# Одна сессия с keep-alive на все вызовы API: requests.post открывал бы
+# новое TCP+TLS соединение на каждый запрос
+_SESSION = requests.Session()
+_SESSION.mount('https://', requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=4))
+_SESSION.headers.update({'Content-Type': 'application/json'})
+
+# С какого числа страниц извлечение распараллеливается по процессам
+_PARALLEL_PAGE_THRESHOLD = 8
+
+def _extract_page_text(file_path: str, index: int) -> str:
+    """Извлекает текст одной страницы (выполняется в отдельном процессе)."""
+    pdf = pdfium.PdfDocument(file_path)
+    try:
+        textpage = pdf[index].get_textpage()
+        return textpage.get_text_range()
+    finally:
+        pdf.close()
+
+def pdf_to_text(file_path: str, fast: bool = True) -> str:
+    """
+    Извлекает текст из PDF.
+
+    В быстром режиме (по умолчанию) текст берётся через PDFium без анализа
+    раскладки страницы — выписка имеет фиксированный формат, и regex-парсеру
+    достаточно сырого построчного текста. fast=False использует PyPDF2
+    (медленнее; пакет должен быть установлен отдельно).
+    """
+    if not fast:
+        import PyPDF2
+        with open(file_path, "rb") as file:
+            reader = PyPDF2.PdfReader(file)
+            return "".join(page.extract_text() or '' for page in reader.pages)
+
+    pdf = pdfium.PdfDocument(file_path)
+    try:
+        n_pages = len(pdf)
+        # PDFium не потокобезопасен, поэтому длинные выписки разбираем
+        # по страницам в отдельных процессах; map сохраняет порядок страниц
+        if n_pages > _PARALLEL_PAGE_THRESHOLD:
+            workers = min(8, os.cpu_count() or 1)
+            with ProcessPoolExecutor(max_workers=workers) as ex:
+                parts = list(ex.map(functools.partial(_extract_page_text, file_path), range(n_pages)))
+            return "\n".join(parts)
+
+        parts = []
+        for page in pdf:
+            textpage = page.get_textpage()
+            parts.append(textpage.get_text_range())
+            textpage.close()
+            page.close()
+        return "\n".join(parts)
+    finally:
+        pdf.close()
 
 def parse_bank_statement(text: str) -> List[Dict[str, Any]]:
     """
@@ -27,78 +117,78 @@ def parse_bank_statement(text: str) -> List[Dict[str, Any]]:
     transactions = []
     
     # Удаляем служебную информацию
-    text = re.sub(r'Страница \d+ из \d+', '', text)
-    text = re.sub(r'Продолжение на следующей странице', '', text)
-    text = re.sub(r'Входящий остаток.*?₽', '', text)
-    text = re.sub(r'Исходящий остаток.*?₽', '', text)
-    
+    text = _RE_NOISE.sub('', text)
+
     # Паттерн для поиска транзакций
     # Ищем: описание + дата_время + дата_обработки + (карта?) + сумма1 + сумма2
-    # Используем более точный паттерн
-    
     # Разбиваем по паттерну даты и времени операции
     # Формат: DD.MM.YYYY в HH:MM
-    pattern = r'(\d{2}\.\d{2}\.\d{4})\s+в\s+(\d{2}:\d{2})'
-    
+
     # Находим все совпадения с их позициями
-    matches = list(re.finditer(pattern, text))
-    
-    for i, match in enumerate(matches):
+    matches = list(_RE_DATETIME.finditer(text))
+
+    # Суммы и даты собираем одним проходом по всему тексту, а в цикле ищем их
+    # по позициям через bisect — иначе хвост text[match.end():] сканируется
+    # заново для каждой транзакции (O(N^2) на длинных выписках)
+    amount_matches = list(_RE_AMOUNT.finditer(text))
+    amount_starts = [m.start() for m in amount_matches]
+    date_matches = list(_RE_DATE.finditer(text))
+    date_starts = [m.start() for m in date_matches]
+
+    # Границы описаний и регионов данных считаем заранее: описание лежит
+    # между концом предыдущей даты и началом текущей, данные — до следующей
+    prev_ends = [0] + [m.end() for m in matches[:-1]]
+    next_starts = [m.start() for m in matches[1:]] + [len(text)]
+
+    for match, prev_end, region_end in zip(matches, prev_ends, next_starts):
         # Позиция начала даты
         date_start = match.start()
         date_str = match.group(1)
         time_str = match.group(2)
         transaction_datetime = f"{date_str} в {time_str}"
-        
-        # Текст до этой даты - это описание
-        if i == 0:
-            prev_end = 0
-        else:
-            prev_end = matches[i-1].end()
-        
-        description = text[prev_end:date_start].strip()
+
+        # Совсем короткий кусок — заведомо мусор, не тратим на него regex-очистку
+        if date_start - prev_end < 5:
+            continue
+
+        desc_raw = text[prev_end:date_start]
         # Удаляем суммы из конца описания
-        description = re.sub(r'[+\-–]\s*\d.*?₽\s*$', '', description, flags=re.MULTILINE)
-        description = re.sub(r'\s+', ' ', description).strip()
-        
-        # Текст после даты содержит остальные данные
-        after_date = text[match.end():]
-        
+        description = _RE_TAIL.sub('', desc_raw)
+        description = _RE_WS.sub(' ', description).strip()
+
+        # Дешёвые фильтры до извлечения дат/карты/сумм: мусорные описания
+        # отбрасываются раньше, чем по региону пройдут остальные поиски
+        if len(description) < 5:
+            continue
+
+        # Пропускаем служебные строки
+        if _RE_SKIP.search(description):
+            continue
+
+        # Остальные данные транзакции лежат между этой датой и следующей
+        region_start = match.end()
+
         # Извлекаем дату обработки (следующая дата после даты операции)
-        processing_date_match = re.search(r'(\d{2}\.\d{2}\.\d{4})', after_date)
-        if not processing_date_match:
+        j = bisect.bisect_left(date_starts, region_start)
+        if j >= len(date_matches) or date_starts[j] >= region_end:
             continue
-        processing_date = processing_date_match.group(1)
-        
-        # Извлекаем карту (опционально)
-        card_match = re.search(r'\*(\d{4,5})', after_date)
+        processing_date = date_matches[j].group(1)
+
+        # Извлекаем карту (опционально); данные транзакции лежат сразу после
+        # даты, поэтому окно поиска ограничиваем — у последней транзакции
+        # region_end иначе упирается в конец текста
+        card_match = _RE_CARD.search(text, region_start, min(region_end, region_start + 256))
         card = '*' + card_match.group(1) if card_match else ''
-        
+
         # Извлекаем две суммы
-        amount_pattern = r'([+\-–])\s*(\d{1,3}(?:\s+\d{3})*(?:,\d{2})?)\s*₽'
-        amounts = re.findall(amount_pattern, after_date)
-        
-        if len(amounts) < 2:
+        k = bisect.bisect_left(amount_starts, region_start)
+        if k + 1 >= len(amount_matches) or amount_starts[k + 1] >= region_end:
             continue
-        
+
         # Очищаем суммы
-        def clean_amount(sign, value):
-            cleaned = value.replace(' ', '').replace(',', '.')
-            # Заменяем длинное тире на минус
-            if sign == '–':
-                sign = '-'
-            return sign + cleaned
-        
-        transaction_amount = clean_amount(amounts[0][0], amounts[0][1])
-        account_amount = clean_amount(amounts[1][0], amounts[1][1])
-        
-        # Пропускаем служебные строки
-        if any(word in description for word in ['Описание операции', 'Дата и время', 'МСК', 'Страница']):
-            continue
-        
-        if len(description) < 5:
-            continue
-        
+        transaction_amount = _clean_amount(*amount_matches[k].group(1, 2))
+        account_amount = _clean_amount(*amount_matches[k + 1].group(1, 2))
+
         transactions.append({
             'Description': description,
             'Transaction_DateTime': transaction_datetime,
@@ -110,31 +200,32 @@ def parse_bank_statement(text: str) -> List[Dict[str, Any]]:
     print(f"{len(transactions)} transactions found")
     return transactions
 
+@functools.lru_cache(maxsize=4)
 def get_zenmoney_data(access_token: str) -> tp.Dict[str, tp.Any]:
     """
     Получает данные из ZenMoney (счета, инструменты, пользователь).
-    
+
+    Результат кэшируется на время работы CLI: import делает convert и post
+    подряд, без кэша каждый шаг ходил бы в API за одними и теми же данными.
+
     Args:
         access_token: OAuth токен доступа
-    
+
     Returns:
         Словарь с данными из ZenMoney API
     """
     url = "https://api.zenmoney.ru/v8/diff/"
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json"
-    }
+    headers = {"Authorization": f"Bearer {access_token}"}
     
     payload = {
-        "currentClientTimestamp": int(datetime.now().timestamp()),
+        "currentClientTimestamp": int(time.time()),
         "serverTimestamp": 0
     }
     
-    response = requests.post(url, json=payload, headers=headers)
+    response = _SESSION.post(url, data=orjson.dumps(payload), headers=headers)
     
     if response.status_code == 200:
-        return response.json()
+        return orjson.loads(response.content)
     else:
         raise Exception(f"Ошибка получения данных: {response.status_code} - {response.text}")
 
@@ -160,10 +251,11 @@ def convert_to_zenmoney_format(
     """
     # Получаем данные из ZenMoney для получения ID валюты и пользователя
     zenmoney_data = get_zenmoney_data(access_token)
-    account_id = [account.get('id') for account in zenmoney_data.get('account', []) if account.get('title') == account_title]
-    if not account_id:
+    accounts_by_title = {a.get('title'): a for a in zenmoney_data.get('account', []) if not a.get('deleted')}
+    account = accounts_by_title.get(account_title)
+    if account is None:
         raise ValueError(f"Не найден счет с названием {account_title}")
-    account_id = account_id[0]
+    account_id = account.get('id')
 
     instruments = zenmoney_data.get('instrument', [])
     users = zenmoney_data.get('user', [])
@@ -180,9 +272,12 @@ def convert_to_zenmoney_format(
         raise ValueError("Не найден инструмент для рубля")
     
     zenmoney_transactions = []
-    current_timestamp = int(datetime.now().timestamp())
-    
-    for txn in transactions:
+    current_timestamp = int(time.time())
+
+    # Энтропию для id берём одним os.urandom вместо syscall на каждый uuid4()
+    raw_uuid_bytes = os.urandom(16 * len(transactions))
+
+    for idx, txn in enumerate(transactions):
         description = txn.get('Description', '').strip()
         date_str = txn.get('Processing_Date', '') or txn.get('Transaction_DateTime', '')
         amount_str = txn.get('Account_Amount', '') or txn.get('Transaction_Amount', '')
@@ -198,32 +293,42 @@ def convert_to_zenmoney_format(
         # Очищаем строку от лишних пробелов и символов
         date_str_clean = date_str.strip()
         
-        # Пробуем разные варианты парсинга
-        date_formats = [
-            '%d.%m.%Y',           # 27.07.2025
-            '%d.%m.%Y в %H:%M',   # 27.07.2025 в 08:16
-            '%Y-%m-%d',           # 2025-07-27 (уже правильный формат)
-            '%d/%m/%Y',           # 27/07/2025
-            '%Y.%m.%d',           # 2025.07.27
-        ]
-        
-        # Сначала пробуем разделить по " в " для формата с временем
-        date_parts = date_str_clean.split(' в ')
-        date_part = date_parts[0].strip() if date_parts else date_str_clean
-        
-        # Пробуем распарсить разными форматами
-        for fmt in date_formats:
+        # Отбрасываем время ('27.07.2025 в 08:16' -> '27.07.2025')
+        date_part = date_str_clean.partition(' в ')[0].strip()
+
+        # Дата уже в ISO-формате (из экспорта ZenMoney) — берём как есть,
+        # но проверяем валидность (месяц/день в допустимых границах)
+        if _RE_ISO_DATE.fullmatch(date_part):
             try:
-                dt = datetime.strptime(date_part, fmt)
-                date = dt.strftime('%Y-%m-%d')
-                break
-            except (ValueError, AttributeError):
-                continue
+                datetime.fromisoformat(date_part)
+                date = date_part
+            except ValueError:
+                pass
+
+        # Один матч покрывает 27.07.2025, 27/07/2025, 2025.07.27
+        anydate_match = None if date else _RE_ANYDATE.fullmatch(date_part)
+        if anydate_match:
+            if anydate_match.group('y1'):
+                year_int = int(anydate_match.group('y1'))
+                month_int = int(anydate_match.group('m1'))
+                day_int = int(anydate_match.group('d1'))
+            else:
+                day_int = int(anydate_match.group('d2'))
+                month_int = int(anydate_match.group('m2'))
+                year_int = int(anydate_match.group('y2'))
+            # Американская запись месяц.день.год
+            if month_int > 12 >= day_int:
+                day_int, month_int = month_int, day_int
+            try:
+                datetime(year_int, month_int, day_int)
+                date = f"{year_int}-{month_int:02d}-{day_int:02d}"
+            except ValueError:
+                pass
         
         # Если не получилось, пробуем извлечь дату регулярным выражением
         if not date:
             # Ищем паттерн DD.MM.YYYY или DD/MM/YYYY
-            date_match = re.search(r'(\d{1,2})[./](\d{1,2})[./](\d{4})', date_str_clean)
+            date_match = _RE_LOOSE_DATE.search(date_str_clean)
             if date_match:
                 try:
                     day, month, year = date_match.groups()
@@ -304,21 +409,15 @@ def convert_to_zenmoney_format(
         comment = description
         
         # Паттерны для извлечения получателя
-        payee_patterns = [
-            r'Входящий перевод СБП, ([^,]+)',
-            r'Исходящий перевод СБП, ([^,]+)',
-            r'Оплата товаров и услуг ([A-Z_0-9]+)',
-        ]
-        
-        for pattern in payee_patterns:
-            match = re.search(pattern, description)
+        for pattern in _PAYEE_PATTERNS:
+            match = pattern.search(description)
             if match:
                 payee = match.group(1).strip()
                 break
         
         # Создаем транзакцию в формате ZenMoney
         transaction = {
-            'id': str(uuid.uuid4()),
+            'id': str(uuid.UUID(bytes=raw_uuid_bytes[idx * 16:(idx + 1) * 16], version=4)),
             'changed': current_timestamp,
             'created': current_timestamp,
             'user': user_id,
@@ -366,16 +465,13 @@ def post_transactions(
         Ответ от API ZenMoney
     """
     url = "https://api.zenmoney.ru/v8/diff/"
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json"
-    }
+    headers = {"Authorization": f"Bearer {access_token}"}
     
     # Получаем serverTimestamp из текущих данных
     zenmoney_data = get_zenmoney_data(access_token)
     server_timestamp = zenmoney_data.get('serverTimestamp', 0)
     
-    current_timestamp = int(datetime.now().timestamp())
+    current_timestamp = int(time.time())
     
     payload = {
         "currentClientTimestamp": current_timestamp,
@@ -383,10 +479,12 @@ def post_transactions(
         "transaction": transactions
     }
     
-    response = requests.post(url, json=payload, headers=headers)
+    # orjson сериализует payload в разы быстрее stdlib json — на больших
+    # выписках это самый горячий шаг на стороне клиента
+    response = _SESSION.post(url, data=orjson.dumps(payload), headers=headers)
     
     if response.status_code == 200:
-        return response.json()
+        return orjson.loads(response.content)
     else:
         raise Exception(f"Ошибка отправки транзакций: {response.status_code} - {response.text}")
 
@@ -458,47 +556,22 @@ def delete_transactions(
     
     # Создаем объекты для удаления
     # Согласно документации, можно использовать либо deletion, либо транзакции с deleted: true
-    current_timestamp = int(datetime.now().timestamp())
+    current_timestamp = int(time.time())
     
     deleted_transactions = []
     for txn in transactions_to_delete:
-        deleted_txn = {
-            'id': txn.get('id'),
-            'changed': current_timestamp,
-            'created': txn.get('created', current_timestamp),
-            'user': user_id,
-            'deleted': True,
-            'incomeInstrument': txn.get('incomeInstrument'),
-            'incomeAccount': txn.get('incomeAccount'),
-            'incomeBankID': txn.get('incomeBankID'),
-            'income': txn.get('income', 0),
-            'outcomeInstrument': txn.get('outcomeInstrument'),
-            'outcomeAccount': txn.get('outcomeAccount'),
-            'outcomeBankID': txn.get('outcomeBankID'),
-            'outcome': txn.get('outcome', 0),
-            'tag': txn.get('tag', []),
-            'merchant': txn.get('merchant'),
-            'payee': txn.get('payee'),
-            'originalPayee': txn.get('originalPayee'),
-            'comment': txn.get('comment', ''),
-            'date': txn.get('date'),
-            'mcc': txn.get('mcc'),
-            'reminderMarker': txn.get('reminderMarker'),
-            'opIncome': txn.get('opIncome'),
-            'opIncomeInstrument': txn.get('opIncomeInstrument'),
-            'opOutcome': txn.get('opOutcome'),
-            'opOutcomeInstrument': txn.get('opOutcomeInstrument'),
-            'latitude': txn.get('latitude'),
-            'longitude': txn.get('longitude')
-        }
+        # Транзакция уже пришла из API в полном виде — копируем её целиком
+        # и переопределяем только поля, помечающие удаление
+        deleted_txn = dict(txn)
+        deleted_txn['changed'] = current_timestamp
+        deleted_txn['user'] = user_id
+        deleted_txn['deleted'] = True
+        deleted_txn.setdefault('created', current_timestamp)
         deleted_transactions.append(deleted_txn)
     
     # Отправляем запрос на удаление
     url = "https://api.zenmoney.ru/v8/diff/"
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json"
-    }
+    headers = {"Authorization": f"Bearer {access_token}"}
     
     payload = {
         "currentClientTimestamp": current_timestamp,
@@ -506,10 +579,10 @@ def delete_transactions(
         "transaction": deleted_transactions
     }
     
-    response = requests.post(url, json=payload, headers=headers)
+    response = _SESSION.post(url, data=orjson.dumps(payload), headers=headers)
     
     if response.status_code == 200:
-        result = response.json()
+        result = orjson.loads(response.content)
         print(f"Успешно удалено транзакций: {len(transactions_to_delete)}")
         return result
     else:
@@ -740,11 +813,10 @@ def list_accounts(ctx):
         click.echo(f"{'Название':<30} {'ID':<40} {'Валюта':<10} {'Удален'}")
         click.echo("-" * 90)
         
+        instruments_by_id = {inst.get('id'): inst for inst in zenmoney_data.get('instrument', [])}
         for acc in accounts:
             if not acc.get('deleted', False):
-                instruments = zenmoney_data.get('instrument', [])
-                inst_id = acc.get('instrument')
-                currency = next((inst.get('shortTitle', '?') for inst in instruments if inst.get('id') == inst_id), '?')
+                currency = instruments_by_id.get(acc.get('instrument'), {}).get('shortTitle', '?')
                 click.echo(f"{acc.get('title', 'N/A'):<30} {acc.get('id', 'N/A'):<40} {currency:<10} {'Нет'}")
     except Exception as e:
         click.echo(f"✗ Ошибка: {e}", err=True)
@@ -2,69 +2,131 @@
 Генерация одностраничного HTML с аналитикой по CSV транзакциям ZenMoney.
 Читает все CSV в репозитории, строит графики Plotly и сохраняет один HTML файл.
 """
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import argparse
-from typing import List
+import hashlib
+import os
+from typing import List, Optional
 
+import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
+import plotly.io as pio
+
+# Кодирование фигур через orjson: to_html на фигурах с большим числом
+# столбцов упирается именно в JSON-сериализацию. Без orjson работаем как раньше
+try:
+    import orjson  # noqa: F401
+    pio.json.config.default_engine = "orjson"
+except ImportError:
+    pass
 
 # Имя категории для пустых/без категории
 OTHER_CAT_LABEL = "Остальное"
 NO_CATEGORY_LABEL = "Без категории"
 
 
-def _str_safe(val, max_len: int = 0):
-    """Приводит значение к строке (API/CSV могут отдавать NaN, float, None)."""
-    if val is None or (isinstance(val, float) and pd.isna(val)):
-        s = ""
-    else:
-        s = str(val)
-    return (s[:max_len] if max_len else s).replace("\n", " ")
+def _walk_csv(root: str):
+    """Рекурсивный os.scandir: тип записи читается из dirent, без stat на файл."""
+    try:
+        it = os.scandir(root)
+    except OSError:
+        return
+    with it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _walk_csv(entry.path)
+            elif entry.name.endswith(".csv") and entry.is_file(follow_symlinks=False):
+                yield Path(entry.path)
 
 
 def find_csv_files(root: Path) -> List[Path]:
     """Находит все CSV файлы в директории и поддиректориях."""
     root = Path(root).resolve()
-    return sorted(root.rglob("*.csv"))
+    return sorted(_walk_csv(str(root)))
+
+
+def _read_one(path: Path) -> Optional[pd.DataFrame]:
+    """Читает один CSV; при ошибке печатает причину и возвращает None."""
+    try:
+        try:
+            # Многопоточный Arrow-парсер читает в разы быстрее и не
+            # аллоцирует Python-объект на каждую ячейку
+            df = pd.read_csv(path, sep=";", encoding="utf-8-sig", engine="pyarrow", dtype_backend="pyarrow")
+        except (ImportError, ValueError):
+            df = pd.read_csv(path, sep=";", encoding="utf-8-sig", dtype=str)
+        # Заголовки нормализуем сразу: у одинаково названных колонок concat
+        # идёт по быстрому пути без выравнивания
+        df.columns = [c.strip().lower() if isinstance(c, str) else c for c in df.columns]
+        df["_source"] = path.name
+        return df
+    except Exception as e:
+        print(f"Пропуск {path}: {e}")
+        return None
 
 
 def load_all_csv(paths: List[Path]) -> pd.DataFrame:
     """Загружает и объединяет все CSV (разделитель ;, utf-8-sig). Имена колонок приводятся к нижнему регистру."""
-    frames = []
-    for p in paths:
-        try:
-            df = pd.read_csv(p, sep=";", encoding="utf-8-sig", dtype=str)
-            df.columns = [c.strip().lower() if isinstance(c, str) else c for c in df.columns]
-            df["_source"] = p.name
-            frames.append(df)
-        except Exception as e:
-            print(f"Пропуск {p}: {e}")
+    if not paths:
+        return pd.DataFrame()
+    # Парсинг CSV отпускает GIL (в pyarrow — полностью), так что чтение
+    # нескольких файлов перекрывается и по I/O, и по ядрам
+    with ThreadPoolExecutor(max_workers=min(8, len(paths))) as ex:
+        frames = [df for df in ex.map(_read_one, paths) if df is not None]
     if not frames:
         return pd.DataFrame()
-    out = pd.concat(frames, ignore_index=True)
+    out = pd.concat(frames)
+    out.reset_index(drop=True, inplace=True)
+    out["_source"] = out["_source"].astype("category")
     return out
 
 
+def load_transactions_cached(paths: List[Path], cache_dir: Path) -> pd.DataFrame:
+    """Загружает и подготавливает CSV с кэшем в Parquet.
+
+    Ключ кэша — пути и mtime исходных файлов: любой изменившийся CSV
+    инвалидирует кэш. Parquet хранит уже типизированный фрейм, поэтому
+    повторный запуск пропускает и парсинг CSV, и приведение типов.
+    """
+    key = hashlib.sha1(repr(sorted((str(p), p.stat().st_mtime_ns) for p in paths)).encode()).hexdigest()
+    cache_path = cache_dir / f"{key}.parquet"
+    if cache_path.exists():
+        try:
+            return pd.read_parquet(cache_path)
+        except Exception as e:
+            print(f"Кэш не прочитался, перечитываю CSV: {e}")
+    df = prepare_data(load_all_csv(paths))
+    if not df.empty:
+        try:
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            df.to_parquet(cache_path, compression="zstd")
+        except Exception as e:
+            print(f"Кэш не сохранился: {e}")
+    return df
+
+
 def prepare_data(df: pd.DataFrame) -> pd.DataFrame:
     """Приводит типы: дата, числа; нормализует категории."""
     if df.empty:
         return df
-    df = df.copy()
-    # Дата
-    df["date"] = pd.to_datetime(df["date"], errors="coerce")
-    df = df.dropna(subset=["date"])
-    # Числа
-    for col in ("income", "outcome", "amount"):
-        if col in df.columns:
-            df[col] = pd.to_numeric(df[col], errors="coerce").fillna(0)
-    # Категория: пустая -> "Без категории" (API/CSV могут отдавать NaN, float)
+    # Без предварительного df.copy(): assign/dropna и так возвращают новый
+    # фрейм, а безусловная копия удваивала пиковую память на самом большом
+    # промежуточном объекте
+    df = df.assign(date=pd.to_datetime(df["date"], errors="coerce")).dropna(subset=["date"])
+    # Числа — одним вызовом по всем колонкам
+    num_cols = [c for c in ("income", "outcome", "amount") if c in df.columns]
+    df[num_cols] = df[num_cols].apply(pd.to_numeric, errors="coerce").fillna(0)
+    # Категория: пустая -> "Без категории"; векторные строковые операции
+    # вместо питоновской функции на каждую строку (API/CSV могут отдавать NaN)
     if "category" not in df.columns:
         df["category"] = NO_CATEGORY_LABEL
     else:
-        df["category"] = df["category"].apply(
-            lambda x: NO_CATEGORY_LABEL if (x is None or (isinstance(x, float) and pd.isna(x)) or str(x).strip() == "") else str(x).strip()
-        )
+        s = df["category"].astype("string").str.strip()
+        df["category"] = s.mask(s.isna() | (s == ""), NO_CATEGORY_LABEL)
+    # Категория как categorical: groupby ниже работает по целочисленным кодам
+    # вместо повторного хеширования строк
+    df["category"] = df["category"].astype("category")
     return df
 
 
@@ -72,53 +134,65 @@ def top_categories(df: pd.DataFrame, top_n: int, by_col: str = "outcome") -> Lis
     """Список топ-N категорий по сумме трат (outcome)."""
     if df.empty or by_col not in df.columns:
         return []
-    agg = df.groupby("category", as_index=False)[by_col].sum()
-    agg = agg.sort_values(by_col, ascending=False)
-    return agg["category"].head(top_n).tolist()
+    agg = df.groupby("category", as_index=False, observed=True)[by_col].sum()
+    # Частичный выбор top-N через кучу вместо полной сортировки
+    return agg.nlargest(top_n, by_col)["category"].tolist()
 
 
-def make_weekly_outcome_by_category_bar(df: pd.DataFrame, min_outcome_per_week: float = 5000) -> go.Figure:
-    """Понедельный bar: расходы по неделям по категориям. Только категории, где в неделю было > min_outcome_per_week."""
-    if df.empty:
-        return go.Figure()
-    expenses = df[df["outcome"] > 0].copy()
+def make_weekly_outcome_by_category_bar(expenses: pd.DataFrame, min_outcome_per_week: float = 5000) -> go.Figure:
+    """Понедельный bar: расходы по неделям по категориям. Только категории, где в неделю было > min_outcome_per_week.
+
+    Принимает уже отфильтрованные расходы (outcome > 0), см. build_html.
+    """
     if expenses.empty:
         return go.Figure()
-    expenses["week"] = expenses["date"].dt.to_period("W").dt.to_timestamp()
-    agg = expenses.groupby(["week", "category"], as_index=False)["outcome"].sum()
-    # Оставляем только категории, у которых хотя бы в одной неделе траты > min_outcome_per_week
-    cat_above = agg[agg["outcome"] >= min_outcome_per_week]["category"].unique()
-    agg = agg[agg["category"].isin(cat_above)]
+    # Начало недели (понедельник) векторной арифметикой над datetime64 —
+    # конвертация через PeriodIndex боксит каждое значение в Python-объект
+    dates = expenses["date"].dt.normalize()
+    # Копия всего фрейма ради колонки "week" не нужна: агрегируем мини-фрейм
+    # из трёх участвующих колонок
+    agg = pd.DataFrame({
+        "week": dates - pd.to_timedelta(dates.dt.weekday, unit="D"),
+        "category": expenses["category"],
+        "outcome": expenses["outcome"],
+    }).groupby(["week", "category"], as_index=False, observed=True)["outcome"].sum()
+    # Оставляем только категории, у которых хотя бы в одной неделе траты
+    # > min_outcome_per_week; сравниваем целочисленные коды categorical,
+    # а не строки через isin
+    cat_codes = agg["category"].cat.codes.to_numpy()
+    keep_codes = np.unique(cat_codes[agg["outcome"].to_numpy() >= min_outcome_per_week])
+    agg = agg.iloc[np.isin(cat_codes, keep_codes)]
     if agg.empty:
         return go.Figure()
-    weeks = sorted(agg["week"].unique())
-    categories = sorted(agg["category"].unique())
-    fig = go.Figure()
-    for cat in categories:
-        cat_df = agg[agg["category"] == cat]
-        by_week = cat_df.set_index("week")["outcome"]
-        y = [float(by_week.get(w, 0)) / 1000 for w in weeks]
-        fig.add_trace(
-            go.Bar(
-                x=weeks,
-                y=y,
-                name=cat,
-                customdata=[cat] * len(weeks),
-                text=[f"{v:.1f}" if v else "" for v in y],
-                textposition="inside",
-                hovertemplate="%{customdata}<br>%{y:.1f} тыс ₽<extra></extra>",
-            )
-        )
-    fig.update_layout(
-        title="Расходы по неделям по категориям (категории с тратами > 5 тыс ₽ в неделю)",
-        xaxis_title="Неделя",
-        yaxis_title="Сумма, тыс. ₽",
+    # Одна сводная таблица неделя x категория вместо фильтра + reindex
+    # на каждую категорию; сразу в тыс. ₽
+    mat = agg.pivot_table(index="week", columns="category", values="outcome", aggfunc="sum", fill_value=0, observed=True).sort_index() / 1000.0
+    weeks = mat.index.to_list()
+    # Трейсы собираем как готовые dict и отдаём фигуре одним куском:
+    # add_trace(go.Bar(...)) прогоняет валидатор по каждому массиву свойств
+    traces = []
+    for cat in mat.columns:
+        y = [float(v) for v in mat[cat].to_numpy()]
+        traces.append(dict(
+            type="bar",
+            x=weeks,
+            y=y,
+            name=cat,
+            customdata=[cat] * len(weeks),
+            text=[f"{v:.1f}" if v else "" for v in y],
+            textposition="inside",
+            hovertemplate="%{customdata}<br>%{y:.1f} тыс ₽<extra></extra>",
+        ))
+    layout = dict(
+        title=dict(text="Расходы по неделям по категориям (категории с тратами > 5 тыс ₽ в неделю)"),
+        xaxis=dict(title=dict(text="Неделя")),
+        yaxis=dict(title=dict(text="Сумма, тыс. ₽")),
         barmode="stack",
         legend=dict(orientation="v", yanchor="top", y=1, xanchor="left", x=1.02),
         margin=dict(t=60, b=50),
         height=400,
     )
-    return fig
+    return go.Figure(dict(data=traces, layout=layout), skip_invalid=True)
 
 
 def make_bar_plot(category_totals: pd.DataFrame, title: str = "Расходы по категориям") -> go.Figure:
@@ -129,25 +203,37 @@ def make_bar_plot(category_totals: pd.DataFrame, title: str = "Расходы п
     # Сумма в рублях -> в тысячах для оси X; длина столбца равна значению в тыс. ₽
     cat["outcome_thous"] = (cat["outcome"].astype(float) / 1000).round(2)
     x_vals = cat["outcome_thous"].tolist()
-    fig = go.Figure(
-        go.Bar(
-            y=cat["category"].tolist(),
-            x=x_vals,
-            orientation="h",
-            text=[f"{v:,.1f} тыс" for v in x_vals],
-            textposition="outside",
-        )
+    trace = dict(
+        type="bar",
+        y=cat["category"].tolist(),
+        x=x_vals,
+        orientation="h",
+        text=[f"{v:,.1f} тыс" for v in x_vals],
+        textposition="outside",
     )
     x_max = max(x_vals) if x_vals else 1
-    fig.update_layout(
-        title=title,
-        xaxis_title="Сумма, тыс. ₽",
-        yaxis_title="",
-        xaxis=dict(range=[0, x_max * 1.15], dtick=None),
+    layout = dict(
+        title=dict(text=title),
+        xaxis=dict(title=dict(text="Сумма, тыс. ₽"), range=[0, x_max * 1.15], dtick=None),
+        yaxis=dict(title=dict(text="")),
         margin=dict(t=50, b=50),
         height=max(300, len(cat) * 22),
     )
-    return fig
+    return go.Figure(dict(data=[trace], layout=layout), skip_invalid=True)
+
+
+def _fig_to_div(fig: go.Figure) -> str:
+    """Сериализует фигуру в <div>, отключая все опциональные блоки (MathJax,
+    авто-анимация, повторная валидация)."""
+    return pio.to_html(
+        fig,
+        full_html=False,
+        include_plotlyjs=False,
+        include_mathjax=False,
+        auto_play=False,
+        validate=False,
+        config={"displayModeBar": True},
+    )
 
 
 def make_summary_html(total_income: float, total_outcome: float) -> str:
@@ -171,40 +257,45 @@ def make_summary_html(total_income: float, total_outcome: float) -> str:
 
 
 def make_table_html(
-    df: pd.DataFrame,
+    expenses: pd.DataFrame,
     top_cats: List[str],
     top_per_cat: int = 10,
 ) -> str:
-    """Таблица: топ категории + топ трат в каждой из них."""
-    if df.empty:
-        return "<p>Нет данных</p>"
-    expenses = df[df["outcome"] > 0].copy()
+    """Таблица: топ категории + топ трат в каждой из них.
+
+    Принимает уже отфильтрованные расходы (outcome > 0), см. build_html.
+    """
     if expenses.empty:
         return "<p>Нет расходов</p>"
     expenses = expenses[expenses["category"].isin(top_cats)]
     if expenses.empty:
         return "<p>Нет расходов в выбранных категориях</p>"
-    cat_totals = expenses.groupby("category", as_index=False)["outcome"].sum()
+    cat_totals = expenses.groupby("category", as_index=False, observed=True)["outcome"].sum()
     cat_totals = cat_totals.sort_values("outcome", ascending=False)
+    # Топ транзакций всех категорий за одну стабильную сортировку + head по
+    # группам — вместо маски и частичной сортировки на каждую категорию
+    top_tx = expenses.sort_values("outcome", ascending=False, kind="mergesort").groupby("category", sort=False, observed=True).head(top_per_cat)
+    # payee/comment — необязательные колонки CSV (как category в prepare_data):
+    # при отсутствии рисуем пустые ячейки
+    for col in ("payee", "comment"):
+        if col not in top_tx.columns:
+            top_tx[col] = ""
+    top_tx_by_cat = {cat: grp for cat, grp in top_tx.groupby("category", sort=False, observed=True)}
     rows = []
     for _, row in cat_totals.iterrows():
         cat = row["category"]
         total = row["outcome"]
         rows.append(f'<tr class="cat-row"><td colspan="4"><strong>{cat}</strong> — всего {total:,.0f} ₽</td></tr>')
-        top_tx = expenses[expenses["category"] == cat].nlargest(top_per_cat, "outcome")
-        for _, t in top_tx.iterrows():
-            date_val = t.get("date")
-            date_str = date_val.strftime("%Y-%m-%d") if hasattr(date_val, "strftime") and pd.notna(date_val) else ""
-            outcome_val = t.get("outcome", 0)
-            try:
-                outcome_fmt = f"{float(outcome_val):,.0f}"
-            except (TypeError, ValueError):
-                outcome_fmt = _str_safe(outcome_val)
-            comment = _str_safe(t.get("comment"), 60)
-            payee = _str_safe(t.get("payee"), 40)
-            rows.append(
-                f'<tr><td>{date_str}</td><td>{outcome_fmt}</td><td>{payee}</td><td>{comment}</td></tr>'
-            )
+        # Форматируем колонки группы векторно: iterrows аллоцирует Series
+        # на каждую строку и зовёт питоновские форматтеры поштучно
+        grp = top_tx_by_cat[cat]
+        date_s = grp["date"].dt.strftime("%Y-%m-%d").fillna("")
+        outcome_s = grp["outcome"].map("{:,.0f}".format)
+        payee_s = grp["payee"].fillna("").astype(str).str.slice(0, 40).str.replace("\n", " ", regex=False)
+        comment_s = grp["comment"].fillna("").astype(str).str.slice(0, 60).str.replace("\n", " ", regex=False)
+        rows.append(
+            ("<tr><td>" + date_s + "</td><td>" + outcome_s + "</td><td>" + payee_s + "</td><td>" + comment_s + "</td></tr>").str.cat(sep="\n")
+        )
     table_body = "\n".join(rows)
     return f"""
     <div class="table-wrap">
@@ -222,30 +313,37 @@ def build_html(
     output_path: Path,
     plotly_cdn: bool = True,
 ) -> None:
-    """Собирает одностраничный HTML с графиками и таблицей."""
+    """Собирает одностраничный HTML из уже подготовленного фрейма.
+
+    Ожидает фрейм после prepare_data (типы приведены, категории
+    нормализованы) — повторное приведение съедало бы выигрыш от кэша.
+    """
     if df.empty:
         raise ValueError("Нет данных для построения отчёта")
-    df = prepare_data(df)
-    expenses = df[df["outcome"] > 0]
-    total_income = df["income"].sum()
-    total_outcome = df["outcome"].sum()
+    # Фильтр расходов считается один раз и передаётся во все потребители
+    expenses = df.loc[df["outcome"].to_numpy() > 0]
+    # Суммы через ndarray: NaN уже заполнены в prepare_data, NA-обработка
+    # pandas здесь не нужна
+    total_income = float(df["income"].to_numpy().sum())
+    total_outcome = float(df["outcome"].to_numpy().sum())
 
     # 1. Расходы по неделям по категориям (только категории с тратами > 5к в неделю)
-    fig_weekly_outcome = make_weekly_outcome_by_category_bar(df, min_outcome_per_week=5000)
+    fig_weekly_outcome = make_weekly_outcome_by_category_bar(expenses, min_outcome_per_week=5000)
     # 2. Bar по категориям (итого), длина столбца = сумма в тыс. ₽
-    cat_totals = expenses.groupby("category", as_index=False)["outcome"].sum()
+    cat_totals = expenses.groupby("category", as_index=False, observed=True)["outcome"].sum()
     cat_totals = cat_totals.sort_values("outcome", ascending=False)
     fig_bar = make_bar_plot(cat_totals)
 
-    plot_weekly_outcome = fig_weekly_outcome.to_html(full_html=False, include_plotlyjs=False, config={"displayModeBar": True})
-    plot_bar = fig_bar.to_html(full_html=False, include_plotlyjs=False, config={"displayModeBar": True})
+    plot_weekly_outcome = _fig_to_div(fig_weekly_outcome)
+    plot_bar = _fig_to_div(fig_bar)
 
     summary_html = make_summary_html(total_income, total_outcome)
-    # Таблица: 5 категорий, по 3 транзакции в каждой
-    table_top_cats = top_categories(expenses, top_n=5)
+    # Таблица: 5 категорий, по 3 транзакции в каждой; топ берём из уже
+    # посчитанного (и отсортированного) агрегата bar-чарта
+    table_top_cats = cat_totals["category"].head(5).tolist()
     if not table_top_cats:
         table_top_cats = [NO_CATEGORY_LABEL]
-    table_html = make_table_html(df, table_top_cats, top_per_cat=3)
+    table_html = make_table_html(expenses, table_top_cats, top_per_cat=3)
 
     plotly_script = (
         '<script src="https://cdn.plot.ly/plotly-2.27.0.min.js"></script>'
@@ -253,13 +351,13 @@ def build_html(
         else ""
     )
 
-    html = f"""<!DOCTYPE html>
+    head_html = f"""<!DOCTYPE html>
 <html lang="ru">
 <head>
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Аналитика ZenMoney</title>
-    {plotly_script if plotly_cdn else ""}
+    {plotly_script}
     <style>
         * {{ box-sizing: border-box; }}
         body {{ font-family: system-ui, -apple-system, sans-serif; margin: 0; padding: 20px; background: #f5f5f5; }}
@@ -286,28 +384,39 @@ def build_html(
     <h1>Аналитика расходов ZenMoney</h1>
     <p>Данные загружены из CSV. В таблице: топ 5 категорий по расходам, по 3 транзакции в каждой.</p>
 
-    {summary_html}
+    """
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    # Пишем документ по частям: полная склейка в одну строку держала бы в
+    # памяти вторую копию много-мегабайтных Plotly-блоков
+    with output_path.open("w", encoding="utf-8") as f:
+        f.write(head_html)
+        f.write(summary_html)
+        f.write("""
 
     <div class="chart-wrap">
         <h2>Расходы по неделям по категориям</h2>
-        {plot_weekly_outcome}
+        """)
+        f.write(plot_weekly_outcome)
+        f.write("""
     </div>
 
     <div class="chart-wrap">
         <h2>Соотношение по категориям (итого)</h2>
-        {plot_bar}
+        """)
+        f.write(plot_bar)
+        f.write("""
     </div>
 
     <div class="table-wrap">
         <h2>Топ категории и крупные траты</h2>
-        {table_html}
+        """)
+        f.write(table_html)
+        f.write("""
     </div>
 </body>
 </html>
-"""
-    output_path = Path(output_path)
-    output_path.parent.mkdir(parents=True, exist_ok=True)
-    output_path.write_text(html, encoding="utf-8")
+""")
     print(f"Сохранено: {output_path}")
 
 
@@ -345,7 +454,7 @@ def main():
         print("CSV файлы не найдены")
         return 1
     print(f"Найдено CSV: {len(paths)}")
-    df = load_all_csv(paths)
+    df = load_transactions_cached(paths, cache_dir=args.csv_dir / "cache")
     if df.empty:
         print("Нет данных для отчёта")
         return 1